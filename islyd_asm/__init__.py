@@ -1,2 +1,2 @@
 __version__ = '0.0.7'
-__all__ = ['instructions', 'parser', 'symbol_table', 'assembler', 'utils', 'ihex']
+__all__ = ['instructions', 'parser', 'symbol_table', 'assembler', 'utils', 'ihex', 'segments', 'expressions', 'layout', 'backends', 'cache', 'macros']
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import warnings
 from collections import OrderedDict
 
 import attr
@@ -7,7 +8,10 @@ import attr
 from .instructions import UnknownInstruction
 from .parser import Parser
 from .symbol_table import SymbolTable, UndefinedSymbol, SymbolRedefinedError
-from .ihex import IHEX_EOF, line_info_to_ihex
+from .segments import SegmentMap, SegmentOverlapError, AddressOverflowError
+from .expressions import ExpressionError
+from .layout import optimize_layout, NotRelocatable
+from .backends import BACKENDS
 
 
 class SyntaxError(Exception):
@@ -22,14 +26,48 @@ class LineInfo:
     opcode = attr.ib(factory=list)
 
 
+def assemble(source, format='ihex', name=None, directory='', optimize=False):
+    """
+Assembles source (an iterable of lines) and returns the output in the given format.
+
+Safe to call from many threads at once: each call works on its own Parser, Assembler,
+symbol table and parsed instructions. The only state shared between calls is the
+instruction registry, which is only replaced as a whole when registering instructions,
+and the compiled expressions cache (functools.lru_cache), holding frozen expressions.
+    """
+    with Assembler(directory=directory) as assembler:
+        return assembler.assemble(source, format, name=name, optimize=optimize)
+
+
 class Assembler:
-    def __init__(self):
-        self.parser = Parser()
+    """ Holds the state of one assembly, see assemble() for concurrent use.
+    Files included with INCBIN stay mapped in memory until close() is called, or the with block using it ends """
+    def __init__(self, directory=''):
+        self.parser = Parser(directory=directory)
         self.symbol_table = SymbolTable()
         # [LineInfo]
         self.parsed_lines = []
+        self.segments = SegmentMap()
+        self.layout_stats = None
         self.line_count = 1
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Releases the files included with INCBIN, compile() can not be called afterwards """
+        self.parser.close()
+
+    def assemble(self, source, format='ihex', name=None, optimize=False):
+        """ Parses, optionally optimizes and compiles source, returns the output in the given format """
+        self.parse(source)
+        if optimize:
+            self.optimize()
+        return self.compile().output(format, name=name)
+
     def parse(self, source):
         """
 Tries to parse source as a valid assembler source.
@@ -37,8 +75,13 @@ source is an iterable of lines.
         """
 
         for line in source:
-            instruction = self.parser.parse_line(line)
-            if instruction is not None:     # Comment or blank line
+            try:
+                instructions = self.parser.expand_line(line)
+            except (ExpressionError, ValueError, OSError) as e:
+                msg = """{exception}\nIn line {line_number}:\n{line}""".format(exception=e, line_number=self.line_count, line=line)
+                raise SyntaxError(msg) from None
+
+            for instruction in instructions:    # none for comments, blank lines and macro definitions
                 line_info = LineInfo(line=line, line_number=self.line_count, instruction=instruction)
                 self.parsed_lines.append(line_info)
 
@@ -52,43 +95,94 @@ source is an iterable of lines.
                     msg = """Unknown instruction in line {line_number}:\n{line}""".format(**attr.asdict(line_info))
                     raise SyntaxError(msg)
 
+                if instruction.size:
+                    self._place(line_info)
+
             self.line_count += 1
 
+        self._place(None)
+
+        if self.parser.recording is not None:
+            raise SyntaxError('MACRO {} without ENDM'.format(self.parser.recording[0]))
+
         if self.symbol_table.dependencies:
             msg = """Undefined symbols:\n{}""".format('\n'.join(self.symbol_table.dependencies))
             raise UndefinedSymbol(msg)
 
         return self
 
+    def optimize(self):
+        """
+Reorders basic blocks so that jumps fall through where possible and drops unreachable ones.
+Must be called between parse() and compile(). Programs that rely on fixed code addresses
+are left untouched with a warning.
+        """
+        try:
+            lines, self.layout_stats = optimize_layout(self.parsed_lines, self.symbol_table)
+        except NotRelocatable as e:
+            warnings.warn('Basic block layout skipped: {}'.format(e))
+            return self
+
+        # Relocated labels are new symbols, definitions are kept as they were
+        self.parsed_lines = lines
+        self.symbol_table = SymbolTable()
+        self.segments = SegmentMap()
+        for line_info in lines:
+            for symbol in line_info.instruction.provided_symbols:
+                self.symbol_table.add(symbol)
+            if line_info.instruction.size:
+                self._place(line_info)
+        self._place(None)
+
+        return self
+
+    def _place(self, line_info):
+        """ Adds line_info to the segment map, closes the open segment when line_info is None """
+        try:
+            if line_info is None:
+                self.segments.close()
+            else:
+                self.segments.place(line_info)
+        except SegmentOverlapError as e:
+            first_line = e.segment.lines[0]
+            msg = """{exception}\nIn segment starting in line {line_number}:\n{line}""".format(exception=e, **attr.asdict(first_line))
+            raise SegmentOverlapError(msg, e.segment) from None
+        except AddressOverflowError as e:
+            msg = """{exception}\nIn line {line_number}:\n{line}""".format(exception=e, **attr.asdict(line_info))
+            raise AddressOverflowError(msg) from None
+
     def compile(self):
         """ Updates each parsed line with the corresponding opcode after resolving symbol dependencies """
+        symbol_table = self.symbol_table.freeze()
         for line_info in self.parsed_lines:
             try:
-                line_info.opcode = line_info.instruction.emit_opcode(self.symbol_table)
+                line_info.opcode = line_info.instruction.emit_opcode(symbol_table)
             except Exception as e:
                 msg = """{exception}\nIn line {line_number}:\n{line}""".format(exception=e, **attr.asdict(line_info))
                 raise SyntaxError(msg) from None
 
         return self
 
+    def included_files(self):
+        """ Returns the paths of the files pulled in by INCBIN, the ones the output depends on besides the source """
+        return self.parser.included_files()
+
     def to_ihex(self):
-        records = []
-        for line in self.parsed_lines:
-            hexrecord = line_info_to_ihex(line)
-            if hexrecord is not None:
-                records.append(hexrecord)
-        records.append(IHEX_EOF)
+        return self.output('ihex')
 
-        return '\n'.join(records)
+    def output(self, format='ihex', name=None):
+        """ Returns the compiled memory image in the given format, see backends.BACKENDS """
+        suffix, backend = BACKENDS[format]
+        return backend(self.segments, name)
 
 
 if __name__ == '__main__':
     import fileinput
 
-    assembler = Assembler()
-    assembler.parse(fileinput.input()).compile()
+    with Assembler() as assembler:
+        assembler.parse(fileinput.input()).compile()
 
-    for line in assembler.parsed_lines:
-        print(line)
+        for line in assembler.parsed_lines:
+            print(line)
 
-    print(assembler.to_ihex())
+        print(assembler.to_ihex())
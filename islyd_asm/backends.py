@@ -0,0 +1,145 @@
+""" Output formats for the assembled memory image.
+
+Every backend takes a SegmentMap (after compiling) and a name for the memory,
+and returns the whole output file as a string. Words are 16 bits wide, one per
+address, and addresses with no code are left as zero.
+"""
+
+import re
+from collections import OrderedDict
+
+from .ihex import IHEX_EOF, segment_to_ihex
+
+
+# format name -> (file suffix, backend)
+BACKENDS = OrderedDict()
+
+
+def register(name, suffix):
+    def decorator(backend):
+        BACKENDS[name] = (suffix, backend)
+        return backend
+    return decorator
+
+
+def format_for_suffix(suffix, default='ihex'):
+    """ Returns the name of the format written to files with the given suffix """
+    for name, (backend_suffix, backend) in BACKENDS.items():
+        if suffix.lower() == backend_suffix:
+            return name
+    return default
+
+
+def word(value):
+    return '{:04X}'.format(value)
+
+
+def depth(segments):
+    """ Number of addresses in the memory, at least one since tools reject empty ones """
+    return max(segments.end, 1)
+
+
+@register('ihex', '.hex')
+def to_ihex(segments, name=None):
+    """ Intel HEX, each segment packed in records of up to 16 bytes """
+    records = []
+    for segment in segments:
+        records.extend(segment_to_ihex(segment))
+    records.append(IHEX_EOF)
+
+    return '\n'.join(records)
+
+
+@register('mem', '.mem')
+def to_mem(segments, name=None):
+    """ Verilog $readmemh file, each segment is preceded by its address """
+    lines = []
+    for segment in segments:
+        lines.append('@{}'.format(word(segment.start)))
+        lines.extend(map(word, segment.words()))
+    return '\n'.join(lines) + '\n'
+
+
+@register('mif', '.mif')
+def to_mif(segments, name=None):
+    """ Altera memory initialization file, gaps between segments are filled with address ranges """
+    lines = [
+        'DEPTH = {};'.format(depth(segments)),
+        'WIDTH = 16;',
+        'ADDRESS_RADIX = HEX;',
+        'DATA_RADIX = HEX;',
+        'CONTENT BEGIN',
+    ]
+
+    def fill(start, end):
+        if start == end - 1:
+            lines.append('    {} : {};'.format(word(start), word(0)))
+        elif start < end:
+            lines.append('    [{}..{}] : {};'.format(word(start), word(end - 1), word(0)))
+
+    address = 0
+    for segment in segments:
+        fill(address, segment.start)
+        for address, value in enumerate(segment.words(), segment.start):
+            lines.append('    {} : {};'.format(word(address), word(value)))
+        address = segment.end
+    fill(address, depth(segments))
+
+    lines.append('END;')
+    return '\n'.join(lines) + '\n'
+
+
+@register('coe', '.coe')
+def to_coe(segments, name=None):
+    """ Xilinx coefficients file. The format has no addresses so gaps are written out as zeros """
+    values = []
+    for segment in segments:
+        values.extend([0] * (segment.start - len(values)))
+        values.extend(segment.words())
+    values.extend([0] * (depth(segments) - len(values)))
+
+    lines = [
+        'memory_initialization_radix=16;',
+        'memory_initialization_vector=',
+        ',\n'.join(map(word, values)) + ';',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def vhdl_identifier(name):
+    """ Turns name into a valid VHDL identifier """
+    identifier = re.sub(r'\W+', '_', name or 'rom').strip('_')
+    identifier = re.sub(r'_+', '_', identifier)
+    if not identifier or not identifier[0].isalpha():
+        identifier = 'rom_' + identifier
+    return identifier.lower()
+
+
+@register('vhdl', '.vhd')
+def to_vhdl(segments, name=None):
+    """ VHDL package with the memory as a constant array, small enough for synthesis tools to infer a block ROM """
+    package = vhdl_identifier(name)
+
+    lines = [
+        'library ieee;',
+        'use ieee.std_logic_1164.all;',
+        '',
+        'package {} is'.format(package),
+        '    constant ROM_DEPTH : natural := {};'.format(depth(segments)),
+        '    constant ROM_WIDTH : natural := 16;',
+        '',
+        '    type rom_t is array (0 to ROM_DEPTH - 1) of std_logic_vector(ROM_WIDTH - 1 downto 0);',
+        '',
+        '    constant ROM : rom_t := (',
+    ]
+
+    for segment in segments:
+        for address, value in enumerate(segment.words(), segment.start):
+            lines.append('        16#{}# => x"{}",'.format(word(address), word(value)))
+
+    lines.extend([
+        '        others => (others => \'0\')',
+        '    );',
+        'end package {};'.format(package),
+    ])
+    return '\n'.join(lines) + '\n'
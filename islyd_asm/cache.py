@@ -0,0 +1,164 @@
+""" Content addressed build cache.
+
+Builds are identified by a hash of the source without comments or blank lines,
+the output options and the assembler version. Which files INCBIN pulls in is
+only known after assembling (macro arguments can name them), so each build key
+gets a manifest listing the files the last build loaded, and the output is
+stored under a hash of the build key and the current contents of those files.
+Manifests list the files relative to the directory of the source, so the same
+sources checked out at different places share their entries.
+
+Entries are written to a temporary file and renamed into place, and readers
+that lose a race against eviction just see a miss, so many jobs can share the
+same directory without locking.
+"""
+
+import io
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path, PurePath
+
+import attr
+
+from . import __version__
+from .parser import Parser
+
+
+CACHE_DIR_ENV = 'ISLYD_ASM_CACHE_DIR'
+CACHE_SIZE_ENV = 'ISLYD_ASM_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+TEMPORARY_SUFFIX = '.tmp'
+TEMPORARY_GRACE = 60 * 60    # seconds after which a temporary file is taken as left over by a killed job
+MANIFEST_SUFFIX = '.deps'
+
+
+def cache_size_from_environment():
+    """ Returns the cache size limit in bytes from the environment, or the default one """
+    try:
+        return int(os.environ[CACHE_SIZE_ENV])
+    except (KeyError, ValueError):
+        return DEFAULT_CACHE_SIZE
+
+
+@attr.s
+class BuildCache:
+    directory = attr.ib(converter=Path)
+    max_size = attr.ib(default=DEFAULT_CACHE_SIZE)  # in bytes, least recently used entries are evicted past this
+
+    def key(self, source, **options):
+        """ Returns the build key for source (an iterable of lines) and the output options """
+        digest = hashlib.sha256()
+        digest.update('islyd-asm {}\n'.format(__version__).encode())
+
+        for name, value in sorted(options.items()):
+            digest.update('{}={!r}\n'.format(name, value).encode())
+
+        for line in source:
+            line = Parser.normalize(line)
+            if line:
+                digest.update(line.encode())
+                digest.update(b'\n')
+
+        return digest.hexdigest()
+
+    def output_key(self, key, dependencies, directory=''):
+        """ Returns the key of the output for build key given the files it depends on, relative to directory.
+        None if any of them is missing """
+        digest = hashlib.sha256(key.encode())
+        for dependency in dependencies:
+            digest.update('\0{}\0'.format(dependency).encode())
+            try:
+                with open(os.path.join(directory, dependency), 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        digest.update(chunk)
+            except FileNotFoundError:
+                return None
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.directory / key
+
+    def manifest_path(self, key):
+        return self.directory / (key + MANIFEST_SUFFIX)
+
+    def fetch(self, key, destination, directory=''):
+        """ Copies the output stored for build key to destination.
+        Returns False if there is none or the files it was built from, relative to directory, changed """
+        manifest = self.manifest_path(key)
+        try:
+            dependencies = manifest.read_text().splitlines()
+            os.utime(str(manifest))
+        except FileNotFoundError:
+            return False
+
+        output_key = self.output_key(key, dependencies, directory)
+        if output_key is None:
+            return False
+
+        entry = self.path(output_key)
+        try:
+            shutil.copyfile(str(entry), str(destination))
+            os.utime(str(entry))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, source, dependencies=(), directory=''):
+        """ Adds the file at source to the cache as the output of build key, built from the files in dependencies.
+        Then evicts entries if the cache grew too big.
+        Dependencies are recorded relative to directory, the one of the source file, so that the same
+        sources checked out somewhere else share the entry """
+        dependencies = [PurePath(os.path.relpath(dependency, directory or os.curdir)).as_posix()
+                        for dependency in dependencies]
+        output_key = self.output_key(key, dependencies, directory)
+        if output_key is None:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(str(source), 'rb') as data:
+            self._write(self.path(output_key), data)
+        self._write(self.manifest_path(key), io.BytesIO(''.join(d + '\n' for d in dependencies).encode()))
+
+        self.evict()
+
+    def _write(self, path, data):
+        """ Atomically replaces the file at path with the contents of the data file object """
+        fd, temporary = tempfile.mkstemp(dir=str(self.directory), suffix=TEMPORARY_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(data, f)
+            os.replace(temporary, str(path))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits in max_size.
+        Temporary files count towards the size, and are removed once older than TEMPORARY_GRACE """
+        entries = []
+        total = 0
+        stale = time.time() - TEMPORARY_GRACE
+        for entry in self.directory.iterdir():
+            try:
+                stat = entry.stat()
+                if entry.suffix == TEMPORARY_SUFFIX and stat.st_mtime < stale:
+                    entry.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+
+            total += stat.st_size
+            if entry.suffix != TEMPORARY_SUFFIX:    # still being written
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+        for mtime, size, entry in sorted(entries, key=lambda item: item[0]):
+            if total <= self.max_size:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
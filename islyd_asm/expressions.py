@@ -0,0 +1,249 @@
+import re
+import operator
+from functools import lru_cache
+
+import attr
+
+
+class ExpressionError(Exception):
+    pass
+
+
+# Plain literal values as found in EQU definitions and label addresses, always hexadecimal
+LITERAL = re.compile(r'(\$|0x)?[\dA-F]+', re.I)
+
+TOKEN = re.compile(r'\s*(?:(?P<number>\$[\dA-F]+|\d[\dA-F]*)|(?P<identifier>[A-Z_]\w*)|(?P<operator><<|>>|[-+*/%&|^~()]))', re.I)
+
+# Shift counts and intermediate values are bounded, so that folding can not build huge integers
+MAX_SHIFT = 16
+MIN_OPERAND = -0x80000000
+MAX_OPERAND = 0xFFFFFFFF
+
+
+def divide(dividend, divisor):
+    """ Integer division truncating towards zero, as in C """
+    quotient = abs(dividend) // abs(divisor)
+    return quotient if (dividend < 0) == (divisor < 0) else -quotient
+
+
+def remainder(dividend, divisor):
+    """ Remainder with the sign of the dividend, as in C """
+    return dividend - divisor * divide(dividend, divisor)
+
+
+def shift(operation):
+    def shifted(value, count):
+        if not 0 <= count <= MAX_SHIFT:
+            raise ValueError('shift count {} out of range 0..{}'.format(count, MAX_SHIFT))
+        return operation(value, count)
+    return shifted
+
+
+# Lowest to highest precedence, same as C
+BINARY_OPERATORS = [
+    {'|': operator.or_},
+    {'^': operator.xor},
+    {'&': operator.and_},
+    {'<<': shift(operator.lshift), '>>': shift(operator.rshift)},
+    {'+': operator.add, '-': operator.sub},
+    {'*': operator.mul, '/': divide, '%': remainder},
+]
+
+UNARY_OPERATORS = {
+    '-': operator.neg,
+    '+': operator.pos,
+    '~': operator.invert,
+}
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Number:
+    value = attr.ib()
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Name:
+    identifier = attr.ib()
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Unary:
+    op = attr.ib()
+    operand = attr.ib()
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Binary:
+    op = attr.ib()
+    left = attr.ib()
+    right = attr.ib()
+
+
+def apply(op, *operands):
+    """ Applies op to integer operands, raising ArithmeticError or ValueError on invalid ones """
+    for operand in operands:
+        if not MIN_OPERAND <= operand <= MAX_OPERAND:
+            raise ValueError('operand {:#x} does not fit in 32 bits'.format(operand))
+
+    if len(operands) == 1:
+        return UNARY_OPERATORS[op](*operands)
+
+    for level in BINARY_OPERATORS:
+        if op in level:
+            return level[op](*operands)
+    raise ValueError('Unknown operator "{}"'.format(op))
+
+
+def tokenize(text):
+    """ Splits text into a list of (kind, token, column) tuples """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        matches = TOKEN.match(text, position)
+        if not matches:
+            column = len(text) - len(text[position:].lstrip())
+            raise ExpressionError(diagnostic(text, column, 'Unexpected character'))
+        kind = matches.lastgroup
+        tokens.append((kind, matches.group(kind), matches.start(kind)))
+        position = matches.end()
+    return tokens
+
+
+def diagnostic(text, column, message):
+    """ Formats message pointing at column of text """
+    return '{} at column {}:\n{}\n{}^'.format(message, column + 1, text, ' ' * column)
+
+
+def parse_number(token):
+    """ Numbers are hexadecimal with or without the dollar prefix, like the rest of the assembler """
+    return int(token.replace('$', ''), 16)
+
+
+@attr.s
+class _ExpressionParser:
+    """ Precedence climbing parser producing a DAG: structurally equal subtrees are shared """
+    text = attr.ib()
+    tokens = attr.ib()
+    position = attr.ib(default=0)
+    nodes = attr.ib(factory=dict)
+
+    def peek(self):
+        try:
+            return self.tokens[self.position]
+        except IndexError:
+            return (None, None, len(self.text))
+
+    def error(self, message, column=None):
+        if column is None:
+            column = self.peek()[2]
+        raise ExpressionError(diagnostic(self.text, column, message))
+
+    def node(self, node):
+        """ Constant folds and interns node """
+        if isinstance(node, Unary) and isinstance(node.operand, Number):
+            node = Number(apply(node.op, node.operand.value))
+        elif isinstance(node, Binary) and isinstance(node.left, Number) and isinstance(node.right, Number):
+            node = Number(apply(node.op, node.left.value, node.right.value))
+        return self.nodes.setdefault(node, node)
+
+    def parse(self):
+        if not self.tokens:
+            self.error('Empty expression')
+        root = self.binary(0)
+        if self.position != len(self.tokens):
+            self.error('Unexpected "{}"'.format(self.peek()[1]))
+        return root
+
+    def binary(self, level):
+        if level == len(BINARY_OPERATORS):
+            return self.unary()
+
+        left = self.binary(level + 1)
+        while True:
+            kind, token, column = self.peek()
+            if kind != 'operator' or token not in BINARY_OPERATORS[level]:
+                return left
+            self.position += 1
+            right = self.binary(level + 1)
+            try:
+                left = self.node(Binary(token, left, right))
+            except (ArithmeticError, ValueError) as e:
+                self.error('Invalid operation "{}" ({})'.format(token, e), column)
+
+    def unary(self):
+        kind, token, column = self.peek()
+        if kind == 'operator' and token in UNARY_OPERATORS:
+            self.position += 1
+            return self.node(Unary(token, self.unary()))
+        return self.primary()
+
+    def primary(self):
+        kind, token, column = self.peek()
+        self.position += 1
+        if kind == 'number':
+            return self.node(Number(parse_number(token)))
+        if kind == 'identifier':
+            return self.node(Name(token))
+        if token == '(':
+            inner = self.binary(0)
+            if self.peek()[1] != ')':
+                self.error('Missing closing parenthesis')
+            self.position += 1
+            return inner
+
+        self.position -= 1
+        if kind is None:
+            self.error('Unexpected end of expression')
+        self.error('Unexpected "{}"'.format(token))
+
+
+@attr.s(frozen=True)
+class Expression:
+    """ Compiled constant expression over symbols, see compile_expression() """
+    text = attr.ib()
+    root = attr.ib()
+    symbols = attr.ib(factory=tuple)   # identifiers this expression depends on, in order of appearance
+
+    @property
+    def is_constant(self):
+        return isinstance(self.root, Number)
+
+    def evaluate(self, lookup, memo=None):
+        """ Folds the expression into an integer.
+        lookup is called with each identifier to get its value, memo maps already folded nodes to their values
+        and can be shared between evaluations against the same symbols """
+        if memo is None:
+            memo = {}
+        return self._fold(self.root, lookup, memo)
+
+    def _fold(self, node, lookup, memo):
+        try:
+            return memo[node]
+        except KeyError:
+            pass
+
+        if isinstance(node, Number):
+            value = node.value
+        elif isinstance(node, Name):
+            value = lookup(node.identifier)
+        else:
+            operands = [self._fold(operand, lookup, memo) for operand in attr.astuple(node, recurse=False)[1:]]
+            try:
+                value = apply(node.op, *operands)
+            except (ArithmeticError, ValueError) as e:
+                raise ExpressionError('Invalid operation "{}" ({}) in expression: {}'.format(node.op, e, self.text)) from None
+
+        memo[node] = value
+        return value
+
+
+@lru_cache(maxsize=4096)
+def compile_expression(text):
+    """ Parses text into an Expression, constant subexpressions are folded right away.
+    Compiled expressions are memoized by their text """
+    text = text.strip()
+    tokens = tokenize(text)
+    root = _ExpressionParser(text, tokens).parse()
+    symbols = tuple(dict.fromkeys(token for kind, token, column in tokens if kind == 'identifier'))
+    return Expression(text=text, root=root, symbols=symbols)
@@ -5,18 +5,24 @@ IHEX_EOF = ':00000001FF'
 RECORD_TYPE_DATA = 0x00
 
 
-def line_info_to_ihex(line_info):
-    if not line_info.instruction.size:
-        return None
+RECORD_LENGTH = 16     # bytes, eight words
 
-    address = int_to_split_hex(line_info.instruction.address)
-    opcode = line_info.opcode
 
-    record = [len(opcode), *address, RECORD_TYPE_DATA, *opcode]
+def ihex_record(address, data, record_type=RECORD_TYPE_DATA):
+    """ Returns a single record for data at address """
+    record = bytearray([len(data), *int_to_split_hex(address), record_type])
+    record.extend(data)
 
     record_sum = sum(record) & 0xFF
     checksum = ((0xFF - record_sum) + 1) & 0xFF
 
     record.append(checksum)
-    record = ''.join('{:02x}'.format(b) for b in record)
-    return ':{}'.format(record)
+    return ':{}'.format(record.hex())
+
+
+def segment_to_ihex(segment):
+    """ Returns the data records for a segment, its contiguous bytes packed in records of up to RECORD_LENGTH bytes.
+    Addresses are word addresses, like everywhere else in the assembler """
+    data = segment.data()
+    return [ihex_record(segment.start + offset // 2, data[offset:offset + RECORD_LENGTH])
+            for offset in range(0, len(data), RECORD_LENGTH)]
@@ -1,18 +1,34 @@
+import os
 import re
+import mmap
+import struct
+import threading
 import attr
 
 from .utils import int_to_split_hex
+from .expressions import LITERAL, Expression, compile_expression
 
-ALL_INSTRUCTIONS = []
+# Registered instructions, in matching order. Replaced as a whole on every registration
+# so that readers always see a consistent tuple without taking the lock.
+ALL_INSTRUCTIONS = ()
+_registry_lock = threading.Lock()
 
 
 def register(instruction):
-    ALL_INSTRUCTIONS.append(instruction)
+    global ALL_INSTRUCTIONS
+    with _registry_lock:
+        ALL_INSTRUCTIONS = ALL_INSTRUCTIONS + (instruction,)
     return instruction
 
 
-def is_instruction(line, instruction):
-    return instruction.can_be(line) not in (None, False)
+def match_instruction(line):
+    """ Returns the first registered instruction that line can be and the match for it,
+    or (UnknownInstruction, None) """
+    for instruction in ALL_INSTRUCTIONS:
+        matches = instruction.can_be(line)
+        if matches not in (None, False):
+            return instruction, matches
+    return UnknownInstruction, None
 
 
 @attr.s
@@ -20,10 +36,14 @@ class Symbol:
     address = attr.ib(default=None)
     identifier = attr.ib(default=None)
     value = attr.ib(default=None)
+    size = attr.ib(default=None)    # in words, for labelled data
 
 
 @attr.s
 class BaseInstruction:
+    """ Instructions are only modified while being parsed. Relocation works on copies and emit_opcode()
+    does not change them, so parsed instructions can be shared between lines. The exception is INCBIN.close(),
+    releasing the included file once the build is over """
     size = attr.ib(default=1)
     address = attr.ib(default=None)
     provided_symbols = attr.ib(factory=list)    # list of Symbol() instances that this instruction provides (say, a label or EQU)
@@ -50,7 +70,7 @@ class BaseInstruction:
 class SimpleInstruction(BaseInstruction):
     """ Instruction that does not require nor provide any Symbol """
     pattern = attr.ib(default=None)
-    opcode = attr.ib(factory=list)    # list of bytes that represent this instruction
+    opcode = attr.ib(default=())    # tuple of bytes that represent this instruction
 
     @classmethod
     def from_data(cls, line, address=None):
@@ -78,11 +98,11 @@ class SimpleInstruction(BaseInstruction):
         return self.opcode
 
 
-def parse_hex_literal(literal):
-    """ Given an hex literal like $1234 returns [0x12, 0x34] """
-    parsed = int(literal.strip().replace('$', ''), 16)
-    hi, lo = int_to_split_hex(parsed)
-    return [hi, lo]
+def split_word(value):
+    """ Given an integer operand returns [hi, lo], negative values are stored in two's complement """
+    if not -0x8000 <= value <= 0xFFFF:
+        raise ValueError('Operand value {} does not fit in 16 bits'.format(value))
+    return int_to_split_hex(value & 0xFFFF)
 
 
 @attr.s
@@ -91,7 +111,8 @@ class MultipleArgumentsInstruction(SimpleInstruction):
     size = attr.ib(default=2)
     pattern = attr.ib(factory=list)
     arguments = attr.ib(factory=dict)
-    value = None
+    value = attr.ib(default=None)
+    expression = attr.ib(default=None)   # compiled Expression when the argument is neither a literal nor an identifier
 
     @classmethod
     def can_be(cls, line):
@@ -108,26 +129,30 @@ class MultipleArgumentsInstruction(SimpleInstruction):
         arguments = self.arguments = matches.groupdict()
         value = arguments.get('value', None)
         identifier = arguments.get('identifier', None)
+        expression = arguments.get('expression', None)
         self.value = value
         if identifier is not None:
             self.required_symbols = [identifier]
+        elif expression is not None:
+            self.expression = compile_expression(expression)
+            self.required_symbols = list(self.expression.symbols)
 
         return self
 
-    def resolve_symbols(self, symbol_table):
-        for identifier in self.required_symbols:
-            self.arguments[identifier] = symbol_table.get(identifier)
-
-    def emit_opcode(self, symbol_table=None):
-        self.resolve_symbols(symbol_table)
-        operand = [0, 0]
-        resolved_symbol_name = self.arguments.get('identifier', None)
-        resolved_symbol = self.arguments.get(resolved_symbol_name, None)
+    def operand_value(self, symbol_table=None):
+        """ Returns the integer argument of this instruction """
+        identifier = self.arguments.get('identifier', None)
 
         if self.value is not None:
-            operand = parse_hex_literal(self.value)
-        elif resolved_symbol is not None:
-            operand = parse_hex_literal(str(resolved_symbol.value))
+            return int(self.value.replace('$', ''), 16)
+        elif identifier is not None:
+            return symbol_table.value_of(identifier)
+        elif self.expression is not None:
+            return symbol_table.evaluate(self.expression)
+        return 0
+
+    def emit_opcode(self, symbol_table=None):
+        operand = split_word(self.operand_value(symbol_table))
 
         full_opcode = list(self.opcode)
         full_opcode.extend(operand)
@@ -138,15 +163,7 @@ class MultipleArgumentsInstruction(SimpleInstruction):
 class BitManipulationInstruction(MultipleArgumentsInstruction):
     size = attr.ib(default=1)
     def emit_opcode(self, symbol_table=None):
-        self.resolve_symbols(symbol_table)
-        operand = 0
-        resolved_symbol_name = self.arguments.get('identifier', None)
-        resolved_symbol = self.arguments.get(resolved_symbol_name, None)
-
-        if self.value is not None:
-            operand = int(self.value)
-        elif resolved_symbol is not None:
-            operand = int(resolved_symbol.value)
+        operand = self.operand_value(symbol_table)
 
         if operand not in range(8):
             raise ValueError('Provided bit number "{}" is not valid for {}'.format(operand, self.__class__.__qualname__))
@@ -161,28 +178,36 @@ class BitManipulationInstruction(MultipleArgumentsInstruction):
 @attr.s
 class BitTestInstruction(BitManipulationInstruction):
     size = attr.ib(default=2)
+    jump_target_expression = attr.ib(default=None)
+
     def parse(self, matches, line=None, address=None):
         super().parse(matches, line, address)
         target_identifier = self.arguments.get('jump_target_identifier', None)
+        target_expression = self.arguments.get('jump_target_expression', None)
         if target_identifier is not None:
             self.required_symbols.append(target_identifier)
+        elif target_expression is not None:
+            self.jump_target_expression = compile_expression(target_expression)
+            self.required_symbols.extend(self.jump_target_expression.symbols)
 
         return self
 
-    def emit_opcode(self, symbol_table=None):
-        opcode = super().emit_opcode(symbol_table)
-        jump_target = [0, 0]
-
+    def jump_target_value(self, symbol_table=None):
+        """ Returns the integer jump target of this instruction """
         target = self.arguments.get('jump_target', None)
-        target_symbol_name = self.arguments.get('jump_target_identifier', None)
-        target_symbol = self.arguments.get(target_symbol_name, None)
+        target_identifier = self.arguments.get('jump_target_identifier', None)
 
         if target is not None:
-            jump_target = parse_hex_literal(str(target))
-        elif target_symbol is not None:
-            jump_target = parse_hex_literal(str(target_symbol.value))
+            return int(target.replace('$', ''), 16)
+        elif target_identifier is not None:
+            return symbol_table.value_of(target_identifier)
+        elif self.jump_target_expression is not None:
+            return symbol_table.evaluate(self.jump_target_expression)
+        return 0
 
-        opcode.extend(jump_target)
+    def emit_opcode(self, symbol_table=None):
+        opcode = super().emit_opcode(symbol_table)
+        opcode.extend(split_word(self.jump_target_value(symbol_table)))
         return opcode
 
 
@@ -219,147 +244,291 @@ class LABEL(SimpleInstruction):
 @attr.s
 class EQU(SimpleInstruction):
     size = attr.ib(default=0)
-    pattern = re.compile(r'(?P<label>\w{3,})\s+EQU\s+(?P<value>[\w$]+)$', re.I)
+    pattern = re.compile(r'(?P<label>\w{3,})\s+EQU\s+(?P<value>.+?)$', re.I)
 
     def parse(self, matches, line=None, address=None):
         identifier = matches.group('label')
         value = matches.group('value')
+        if not LITERAL.fullmatch(value):
+            self.required_symbols = list(compile_expression(value).symbols)
         sym = Symbol(identifier=identifier, value=value, address=self.address)
         self.provided_symbols = [sym]
         return self
 
 
+@register
+@attr.s
+class ORG(SimpleInstruction):
+    """ Moves the current address to a fixed location """
+    size = attr.ib(default=0)
+    origin = attr.ib(default=None)
+    pattern = re.compile(r'\s*ORG\s+(?P<origin>\$[\dA-F]{1,4})\s*', re.I)
+
+    def parse(self, matches, line=None, address=None):
+        self.origin = int(matches.group('origin').replace('$', ''), 16)
+        return self
+
+
+@attr.s
+class DataDirective(SimpleInstruction):
+    """ Comma separated data values, optionally labelled as in "table: DW $1234, $5678" """
+    size = attr.ib(default=0)
+    values = attr.ib(factory=list)      # integers, or Expression instances to fold when compiling
+    value_size = 1                      # in bytes
+
+    def parse(self, matches, line=None, address=None):
+        items = [item.strip() for item in matches.group('values').split(',')]
+        if all(LITERAL.fullmatch(item) for item in items):
+            self.values = [int(item.replace('$', ''), 16) for item in items]
+        else:
+            self.values = [compile_expression(item) for item in items]
+            self.required_symbols = list(dict.fromkeys(symbol for value in self.values for symbol in value.symbols))
+
+        self.size = (len(items) * self.value_size + 1) // 2
+        self.provide_label(matches.group('label'))
+        return self
+
+    def provide_label(self, identifier):
+        if identifier is not None:
+            label = Symbol(identifier=identifier, value=hex(self.address), address=self.address, size=self.size)
+            self.provided_symbols = [label]
+
+    @property
+    def expressions(self):
+        return [value for value in self.values if isinstance(value, Expression)]
+
+    def emit_opcode(self, symbol_table=None):
+        values = [symbol_table.evaluate(value) if isinstance(value, Expression) else value for value in self.values]
+        return self.pack(values)
+
+    def pack(self, values):
+        """ Returns values as bytes, padded to a whole number of words """
+        raise NotImplementedError
+
+
+@register
+@attr.s
+class DB(DataDirective):
+    pattern = re.compile(r'(?:(?P<label>\w+):\s*)?DB\s+(?P<values>.+)', re.I)
+
+    def pack(self, values):
+        for value in values:
+            if not -0x80 <= value <= 0xFF:
+                raise ValueError('Value {} does not fit in a byte'.format(value))
+        data = bytes(value & 0xFF for value in values)
+        if len(data) % 2:
+            data += b'\0'
+        return data
+
+
+@register
+@attr.s
+class DW(DataDirective):
+    pattern = re.compile(r'(?:(?P<label>\w+):\s*)?DW\s+(?P<values>.+)', re.I)
+    value_size = 2
+
+    def pack(self, values):
+        for value in values:
+            if not -0x8000 <= value <= 0xFFFF:
+                raise ValueError('Value {} does not fit in 16 bits'.format(value))
+        return struct.pack('>{}H'.format(len(values)), *(value & 0xFFFF for value in values))
+
+
+@register
+@attr.s
+class INCBIN(DataDirective):
+    """ Includes a binary file, or length bytes of it starting at offset, as raw data.
+    The file is mapped in memory and only copied once, when emitting the opcode.
+    close() releases the map, usually done by the Assembler once the build is over """
+    filename = attr.ib(default=None)
+    offset = attr.ib(default=0)
+    length = attr.ib(default=None)
+    label = attr.ib(default=None)
+    data = attr.ib(default=None, repr=False)    # memoryview over the mapped file, see load()
+    mapping = attr.ib(default=None, repr=False, eq=False)
+    pattern = re.compile(r'(?:(?P<label>\w+):\s*)?INCBIN\s+"(?P<filename>[^"]+)"'
+                         r'(?:\s*,\s*(?P<offset>\$?[\dA-F]+)(?:\s*,\s*(?P<length>\$?[\dA-F]+))?)?\s*', re.I)
+
+    def parse(self, matches, line=None, address=None):
+        self.filename = matches.group('filename')
+        offset = matches.group('offset')
+        length = matches.group('length')
+        if offset is not None:
+            self.offset = int(offset.replace('$', ''), 16)
+        if length is not None:
+            self.length = int(length.replace('$', ''), 16)
+        self.label = matches.group('label')
+        return self
+
+    def load(self, directory=''):
+        """ Maps the file, relative to directory, and works out the size of this instruction """
+        with open(os.path.join(directory, self.filename), 'rb') as f:
+            try:
+                data = self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty files can not be mapped
+                data = b''
+
+        if self.offset > len(data):
+            raise ValueError('Offset ${:X} is past the end of "{}" (${:X} bytes long)'.format(
+                self.offset, self.filename, len(data)))
+
+        available = len(data) - self.offset
+        length = available if self.length is None else self.length
+        if length > available:
+            raise ValueError('"{}" has only ${:X} bytes from offset ${:X}, ${:X} requested'.format(
+                self.filename, available, self.offset, length))
+
+        self.data = memoryview(data)[self.offset:self.offset + length]
+        self.size = (length + 1) // 2
+        self.provide_label(self.label)
+        return self
+
+    def close(self):
+        """ Unmaps the file, the opcode can not be emitted afterwards """
+        if self.data is not None:
+            self.data.release()
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def emit_opcode(self, symbol_table=None):
+        data = self.data.tobytes()
+        if len(data) % 2:
+            data += b'\0'
+        return data
+
+
 @register
 @attr.s
 class RST(SimpleInstruction):
     pattern = re.compile(r'\s*RST\s*', re.I)
-    opcode = attr.ib(default=[0x80, 0x00])
+    opcode = attr.ib(default=(0x80, 0x00))
 
 
 @register
 @attr.s
 class CLR_RX(SimpleInstruction):
     pattern = re.compile(r'\s*CLR RX\s*', re.I)
-    opcode = attr.ib(default=[0x00, 0x00])
+    opcode = attr.ib(default=(0x00, 0x00))
 
 
 @register
 @attr.s
 class INC_RX(SimpleInstruction):
     pattern = re.compile(r'\s*INC RX\s*', re.I)
-    opcode = attr.ib(default=[0x01, 0x00])
+    opcode = attr.ib(default=(0x01, 0x00))
 
 
 @register
 @attr.s
 class DEC_RX(SimpleInstruction):
     pattern = re.compile(r'\s*DEC RX\s*', re.I)
-    opcode = attr.ib(default=[0x03, 0x00])
+    opcode = attr.ib(default=(0x03, 0x00))
 
 
 @register
 @attr.s
 class NOP(SimpleInstruction):
     pattern = re.compile(r'\s*NOP\s*', re.I)
-    opcode = attr.ib(default=[0x04, 0x00])
+    opcode = attr.ib(default=(0x04, 0x00))
 
 
 @register
 @attr.s
 class NOT(SimpleInstruction):
     pattern = re.compile(r'\s*NOT\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x11])
+    opcode = attr.ib(default=(0x07, 0x11))
 
 
 @register
 @attr.s
 class SWAP(SimpleInstruction):
     pattern = re.compile(r'\s*SWAP RX\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x12])
+    opcode = attr.ib(default=(0x07, 0x12))
 
 
 @register
 @attr.s
 class SLA(SimpleInstruction):
     pattern = re.compile(r'\s*SLA RX\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x13])
+    opcode = attr.ib(default=(0x07, 0x13))
 
 
 @register
 @attr.s
 class SRA(SimpleInstruction):
     pattern = re.compile(r'\s*SRA RX\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x14])
+    opcode = attr.ib(default=(0x07, 0x14))
 
 
 @register
 @attr.s
 class SLL(SimpleInstruction):
     pattern = re.compile(r'\s*SLL RX\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x15])
+    opcode = attr.ib(default=(0x07, 0x15))
 
 
 @register
 @attr.s
 class SLR(SimpleInstruction):
     pattern = re.compile(r'\s*SLR RX\s*', re.I)
-    opcode = attr.ib(default=[0x07, 0x16])
+    opcode = attr.ib(default=(0x07, 0x16))
 
 
 @register
 @attr.s
 class DEC_RX_IF_NOT_ZERO(SimpleInstruction):
     pattern = re.compile(r'\s*DEC RX IF NOT ZERO\s*', re.I)
-    opcode = attr.ib(default=[0x13, 0x00])
+    opcode = attr.ib(default=(0x13, 0x00))
 
 
 @register
 @attr.s
 class STR_RXL_PORTA(SimpleInstruction):
     pattern = re.compile(r'\s*STR RXL PORTA\s*', re.I)
-    opcode = attr.ib(default=[0x08, 0x00])
+    opcode = attr.ib(default=(0x08, 0x00))
 
 
 @register
 @attr.s
 class INC_PORTA(SimpleInstruction):
     pattern = re.compile(r'\s*INC PORTA\s*', re.I)
-    opcode = attr.ib(default=[0x0B, 0x00])
+    opcode = attr.ib(default=(0x0B, 0x00))
 
 
 @register
 @attr.s
 class DEC_PORTA(SimpleInstruction):
     pattern = re.compile(r'\s*DEC PORTA\s*', re.I)
-    opcode = attr.ib(default=[0x0C, 0x00])
+    opcode = attr.ib(default=(0x0C, 0x00))
 
 
 @register
 @attr.s
 class LDI_RXH_PORTB(SimpleInstruction):
     pattern = re.compile(r'\s*LDI RXH PORTB\s*', re.I)
-    opcode = attr.ib(default=[0x0D, 0x00])
+    opcode = attr.ib(default=(0x0D, 0x00))
 
 
 @register
 @attr.s
 class INC_IX(SimpleInstruction):
     pattern = re.compile(r'\s*INC IX\s*', re.I)
-    opcode = attr.ib(default=[0x15, 0x00])
+    opcode = attr.ib(default=(0x15, 0x00))
 
 
 @register
 @attr.s
 class LDD_RX_IX(SimpleInstruction):
     pattern = re.compile(r'\s*LDD RX,\s*IX\s*', re.I)
-    opcode = attr.ib(default=[0x16, 0x00])
+    opcode = attr.ib(default=(0x16, 0x00))
 
 
 @register
 @attr.s
 class STR_RX_IX(SimpleInstruction):
     pattern = re.compile(r'\s*STR RX,\s*IX\s*', re.I)
-    opcode = attr.ib(default=[0x17, 0x00])
+    opcode = attr.ib(default=(0x17, 0x00))
 
 
 @register
@@ -367,9 +536,10 @@ class STR_RX_IX(SimpleInstruction):
 class LDI_IX(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*LDI IX,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*LDI IX,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*LDI IX,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*LDI IX,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x14, 0x00])
+    opcode = attr.ib(default=(0x14, 0x00))
 
 
 @register
@@ -377,9 +547,10 @@ class LDI_IX(MultipleArgumentsInstruction):
 class LDI_RX(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*LDI RX,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*LDI RX,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*LDI RX,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*LDI RX,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x02, 0x00])
+    opcode = attr.ib(default=(0x02, 0x00))
 
 
 @register
@@ -387,9 +558,10 @@ class LDI_RX(MultipleArgumentsInstruction):
 class LDD_RX(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*LDD RX,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*LDD RX,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*LDD RX,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*LDD RX,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x05, 0x00])
+    opcode = attr.ib(default=(0x05, 0x00))
 
 
 @register
@@ -397,9 +569,10 @@ class LDD_RX(MultipleArgumentsInstruction):
 class STR_RX(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*STR RX,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*STR RX,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*STR RX,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*STR RX,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x06, 0x00])
+    opcode = attr.ib(default=(0x06, 0x00))
 
 
 @register
@@ -407,9 +580,10 @@ class STR_RX(MultipleArgumentsInstruction):
 class JMP_PC(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*JMP PC,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*JMP PC,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*JMP PC,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*JMP PC,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x10, 0x00])
+    opcode = attr.ib(default=(0x10, 0x00))
 
 
 @register
@@ -417,9 +591,10 @@ class JMP_PC(MultipleArgumentsInstruction):
 class JMP_PC_IF_Z(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*JMP PC IF Z,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*JMP PC IF Z,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*JMP PC IF Z,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*JMP PC IF Z,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x11, 0x00])
+    opcode = attr.ib(default=(0x11, 0x00))
 
 
 @register
@@ -427,9 +602,10 @@ class JMP_PC_IF_Z(MultipleArgumentsInstruction):
 class JMP_PC_IF_C(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*JMP PC IF C,\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*JMP PC IF C,\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*JMP PC IF C,\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*JMP PC IF C,\s*(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x12, 0x00])
+    opcode = attr.ib(default=(0x12, 0x00))
 
 
 @register
@@ -437,9 +613,10 @@ class JMP_PC_IF_C(MultipleArgumentsInstruction):
 class AND(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*AND\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*AND\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*AND\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*AND\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x18])
+    opcode = attr.ib(default=(0x07, 0x18))
 
 
 @register
@@ -447,9 +624,10 @@ class AND(MultipleArgumentsInstruction):
 class NAND(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*NAND\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*NAND\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*NAND\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*NAND\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x19])
+    opcode = attr.ib(default=(0x07, 0x19))
 
 
 @register
@@ -457,9 +635,10 @@ class NAND(MultipleArgumentsInstruction):
 class OR(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*OR\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*OR\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*OR\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*OR\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x1A])
+    opcode = attr.ib(default=(0x07, 0x1A))
 
 
 @register
@@ -467,9 +646,10 @@ class OR(MultipleArgumentsInstruction):
 class NOR(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*NOR\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*NOR\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*NOR\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*NOR\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x1B])
+    opcode = attr.ib(default=(0x07, 0x1B))
 
 
 @register
@@ -477,9 +657,10 @@ class NOR(MultipleArgumentsInstruction):
 class XOR(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*XOR\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*XOR\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*XOR\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*XOR\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x1C])
+    opcode = attr.ib(default=(0x07, 0x1C))
 
 
 @register
@@ -487,9 +668,10 @@ class XOR(MultipleArgumentsInstruction):
 class XNOR(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*XNOR\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*XNOR\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*XNOR\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*XNOR\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x1D])
+    opcode = attr.ib(default=(0x07, 0x1D))
 
 
 @register
@@ -497,9 +679,10 @@ class XNOR(MultipleArgumentsInstruction):
 class ADD(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*ADD\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*ADD\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*ADD\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*ADD\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x08])
+    opcode = attr.ib(default=(0x07, 0x08))
 
 
 @register
@@ -507,9 +690,10 @@ class ADD(MultipleArgumentsInstruction):
 class ADDC(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*ADDC\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*ADDC\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*ADDC\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*ADDC\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x09])
+    opcode = attr.ib(default=(0x07, 0x09))
 
 
 @register
@@ -517,9 +701,10 @@ class ADDC(MultipleArgumentsInstruction):
 class SUB(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*SUB\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*SUB\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*SUB\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*SUB\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x0A])
+    opcode = attr.ib(default=(0x07, 0x0A))
 
 
 @register
@@ -527,9 +712,10 @@ class SUB(MultipleArgumentsInstruction):
 class SUBC(MultipleArgumentsInstruction):
     pattern = [
         re.compile(r'\s*SUBC\s+(?P<value>\$[\dA-F]{1,4})\s*', re.I),
-        re.compile(r'\s*SUBC\s+(?P<identifier>\w{3,})\s*', re.I)
+        re.compile(r'\s*SUBC\s+(?P<identifier>\w{3,})\s*', re.I),
+        re.compile(r'\s*SUBC\s+(?P<expression>[^,]+?)\s*', re.I)
     ]
-    opcode = attr.ib(default=[0x07, 0x0B])
+    opcode = attr.ib(default=(0x07, 0x0B))
 
 
 @register
@@ -537,9 +723,10 @@ class SUBC(MultipleArgumentsInstruction):
 class BIT_SET_A(BitManipulationInstruction):
     pattern = [
         re.compile(r'\s*BIT SET\s+(?P<value>[0-7])\s*,\s*PORTA', re.I),
-        re.compile(r'\s*BIT SET\s+(?P<identifier>\w{3,})\s*,\s*PORTA', re.I)
+        re.compile(r'\s*BIT SET\s+(?P<identifier>\w{3,})\s*,\s*PORTA', re.I),
+        re.compile(r'\s*BIT SET\s+(?P<expression>[^,]+?)\s*,\s*PORTA', re.I)
     ]
-    opcode = attr.ib(default=[0x09])
+    opcode = attr.ib(default=(0x09,))
 
 
 @register
@@ -547,9 +734,10 @@ class BIT_SET_A(BitManipulationInstruction):
 class BIT_CLR_A(BitManipulationInstruction):
     pattern = [
         re.compile(r'\s*BIT CLR\s+(?P<value>[0-7])\s*,\s*PORTA', re.I),
-        re.compile(r'\s*BIT CLR\s+(?P<identifier>\w{3,})\s*,\s*PORTA', re.I)
+        re.compile(r'\s*BIT CLR\s+(?P<identifier>\w{3,})\s*,\s*PORTA', re.I),
+        re.compile(r'\s*BIT CLR\s+(?P<expression>[^,]+?)\s*,\s*PORTA', re.I)
     ]
-    opcode = attr.ib(default=[0x0A])
+    opcode = attr.ib(default=(0x0A,))
 
 
 @register
@@ -559,9 +747,10 @@ class BIT_TEST_CLR_B(BitTestInstruction):
         re.compile(r'\s*BTJC\s+(?P<value>[0-7])\s*,\s*(?P<jump_target>\$[\dA-F]{1,4})\s*,\s*PORTB', re.I),
         re.compile(r'\s*BTJC\s+(?P<value>[0-7])\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I),
         re.compile(r'\s*BTJC\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target>\$[\dA-F]{1,4})\s*,\s*PORTB', re.I),
-        re.compile(r'\s*BTJC\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I)
+        re.compile(r'\s*BTJC\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I),
+        re.compile(r'\s*BTJC\s+(?P<expression>[^,]+?)\s*,\s*(?P<jump_target_expression>[^,]+?)\s*,\s*PORTB', re.I)
     ]
-    opcode = attr.ib(default=[0x0E])
+    opcode = attr.ib(default=(0x0E,))
 
 
 @register
@@ -571,6 +760,7 @@ class BIT_TEST_SET_B(BitTestInstruction):
         re.compile(r'\s*BTJS\s+(?P<value>[0-7])\s*,\s*(?P<jump_target>\$[\dA-F]{1,4})\s*,\s*PORTB', re.I),
         re.compile(r'\s*BTJS\s+(?P<value>[0-7])\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I),
         re.compile(r'\s*BTJS\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target>\$[\dA-F]{1,4})\s*,\s*PORTB', re.I),
-        re.compile(r'\s*BTJS\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I)
+        re.compile(r'\s*BTJS\s+(?P<identifier>\w{3,})\s*,\s*(?P<jump_target_identifier>\w{3,})\s*,\s*PORTB', re.I),
+        re.compile(r'\s*BTJS\s+(?P<expression>[^,]+?)\s*,\s*(?P<jump_target_expression>[^,]+?)\s*,\s*PORTB', re.I)
     ]
-    opcode = attr.ib(default=[0x0F])
+    opcode = attr.ib(default=(0x0F,))
@@ -0,0 +1,353 @@
+""" Basic block layout pass.
+
+The parsed program is split into basic blocks at labels and after flow control
+instructions. Blocks that fall through into the next one are kept together as
+chains. A chain that ends in an unconditional JMP PC to the head of another chain
+gets that chain placed right after it and the jump removed, heaviest edges first
+(jumps nested deeper in loops weigh more). Chains that can not be reached from the
+start of a segment or from a label used as data, and hold no data, are dropped.
+
+A jump right after an instruction that can skip it (DEC RX IF NOT ZERO) does not
+end its block: when skipped, execution goes on with the code that follows it.
+
+Everything is relocated afterwards, so the pass refuses to run when the program
+depends on absolute code addresses: jumps to literal or computed addresses and
+expressions mixing more than one label.
+"""
+
+import attr
+
+from .instructions import (LABEL, EQU, ORG, RST, JMP_PC, JMP_PC_IF_Z, JMP_PC_IF_C, DEC_RX_IF_NOT_ZERO,
+                           BitTestInstruction, MultipleArgumentsInstruction, DataDirective)
+from .expressions import LITERAL, Name, compile_expression
+
+
+CONDITIONAL_JUMPS = (JMP_PC_IF_Z, JMP_PC_IF_C, BitTestInstruction)
+SKIP_INSTRUCTIONS = (DEC_RX_IF_NOT_ZERO,)
+
+
+class NotRelocatable(Exception):
+    pass
+
+
+@attr.s
+class LayoutStats:
+    removed_jumps = attr.ib(default=0)
+    dropped_blocks = attr.ib(default=0)
+    saved_words = attr.ib(default=0)
+
+
+@attr.s(eq=False)
+class BasicBlock:
+    lines = attr.ib(factory=list)   # [LineInfo]
+    guarded = attr.ib(default=False)    # the last instruction comes right after one that may skip it
+
+    @property
+    def labels(self):
+        return [label for line in self.lines for label in defined_labels(line.instruction)]
+
+    @property
+    def has_data(self):
+        return any(isinstance(line.instruction, DataDirective) for line in self.lines)
+
+    @property
+    def last(self):
+        for line in reversed(self.lines):
+            if line.instruction.size:
+                return line.instruction
+        return None
+
+    @property
+    def falls_through(self):
+        return self.guarded or not isinstance(self.last, (JMP_PC, RST))
+
+    @property
+    def targets(self):
+        """ Labels this block may jump to """
+        return [target for target in map(jump_target, (line.instruction for line in self.lines)) if target]
+
+
+@attr.s(eq=False)
+class Chain:
+    """ Blocks that must stay together because each one falls through into the next """
+    index = attr.ib()
+    blocks = attr.ib(factory=list)
+    next = attr.ib(default=None)
+    previous = attr.ib(default=None)
+
+    @property
+    def lines(self):
+        return [line for block in self.blocks for line in block.lines]
+
+    @property
+    def head_labels(self):
+        head = self.blocks[0]
+        labels = []
+        for line in head.lines:
+            if isinstance(line.instruction, LABEL):
+                labels.append(line.instruction.provided_symbols[0].identifier)
+            elif line.instruction.size:
+                break
+        return labels
+
+
+def defined_labels(instruction):
+    """ Returns the identifiers of the labels bound to the address of instruction """
+    if isinstance(instruction, (LABEL, DataDirective)):
+        return [symbol.identifier for symbol in instruction.provided_symbols]
+    return []
+
+
+def is_jump(instruction):
+    return isinstance(instruction, (JMP_PC,) + CONDITIONAL_JUMPS)
+
+
+def jump_target(instruction):
+    """ Returns the label instruction jumps to, None if it is not a jump or the target is not a name """
+    if isinstance(instruction, BitTestInstruction):
+        identifier = instruction.arguments.get('jump_target_identifier', None)
+        expression = instruction.jump_target_expression
+    elif is_jump(instruction):
+        identifier = instruction.arguments.get('identifier', None)
+        expression = instruction.expression
+    else:
+        return None
+
+    # Names shorter than three characters are only matched as expressions
+    if identifier is None and expression is not None and isinstance(expression.root, Name):
+        return expression.root.identifier
+    return identifier
+
+
+def jump_literal(instruction):
+    """ Returns the literal address instruction jumps to, None if there is none """
+    if isinstance(instruction, BitTestInstruction):
+        return instruction.arguments.get('jump_target', None)
+    return instruction.value
+
+
+def label_resolver(lines, symbol_table):
+    """ Returns a function mapping an identifier to the set of labels it depends on, following EQU definitions """
+    labels = {label for line in lines for label in defined_labels(line.instruction)}
+    resolved = {}
+
+    def labels_of(identifier):
+        if identifier in labels:
+            return {identifier}
+        if identifier in resolved:
+            return resolved[identifier]
+        resolved[identifier] = set()
+        value = str(symbol_table.get(identifier).value).strip()
+        if not LITERAL.fullmatch(value):
+            resolved[identifier] = set().union(*map(labels_of, compile_expression(value).symbols))
+        return resolved[identifier]
+
+    return labels_of
+
+
+def check_relocatable(lines, labels_of):
+    """ Raises NotRelocatable when moving code around would change what the program does """
+    for line in lines:
+        instruction = line.instruction
+        if is_jump(instruction) and jump_target(instruction) is None:
+            if jump_literal(instruction) is not None:
+                raise NotRelocatable('Jump to an absolute address in line {}'.format(line.line_number))
+            raise NotRelocatable('Jump to a computed address in line {}'.format(line.line_number))
+
+        if isinstance(instruction, DataDirective):
+            dependencies = [expression.symbols for expression in instruction.expressions]
+        elif isinstance(instruction, (EQU, MultipleArgumentsInstruction)):
+            dependencies = [instruction.required_symbols]
+        else:
+            dependencies = []
+
+        for symbols in dependencies:
+            used = set().union(*map(labels_of, symbols))
+            if len(used) > 1:
+                raise NotRelocatable('Line {} depends on the distance between labels {}'.format(
+                    line.line_number, ', '.join(sorted(used))))
+
+
+def split_segments(lines):
+    """ Splits lines at ORG directives, returns a list of (start address, lines) """
+    segments = []
+    start = lines[0].instruction.address if lines else 0
+    current = []
+    for line in lines:
+        if isinstance(line.instruction, ORG):
+            segments.append((start, current))
+            start = line.instruction.origin
+            current = [line]
+        else:
+            current.append(line)
+    segments.append((start, current))
+    return segments
+
+
+def split_blocks(lines):
+    blocks = [BasicBlock()]
+    previous = None
+    for line in lines:
+        instruction = line.instruction
+        current = blocks[-1]
+        if isinstance(instruction, LABEL) and current.last is not None:
+            current = BasicBlock()
+            blocks.append(current)
+        current.lines.append(line)
+        if instruction.size:
+            current.guarded = isinstance(previous, SKIP_INSTRUCTIONS)
+            previous = instruction
+        if (is_jump(instruction) or isinstance(instruction, RST)) and not current.guarded:
+            blocks.append(BasicBlock())
+    return [block for block in blocks if block.lines]
+
+
+def split_chains(blocks):
+    chains = []
+    falls_through = False
+    for block in blocks:
+        if not falls_through:
+            chains.append(Chain(index=len(chains)))
+        chains[-1].blocks.append(block)
+        falls_through = block.falls_through
+    return chains
+
+
+def loop_depths(lines):
+    """ Estimates how deep in loops each line is, every backward jump closes a loop """
+    position = {}
+    for index, line in enumerate(lines):
+        if isinstance(line.instruction, LABEL):
+            position[line.instruction.provided_symbols[0].identifier] = index
+
+    depths = [0] * (len(lines) + 1)
+    for index, line in enumerate(lines):
+        start = position.get(jump_target(line.instruction), None)
+        if start is not None and start <= index:
+            depths[start] += 1
+            depths[index + 1] -= 1
+
+    depth = 0
+    for index in range(len(lines)):
+        depth += depths[index]
+        depths[index] = depth
+    return {id(line): depths[index] for index, line in enumerate(lines)}
+
+
+def layout_segment(lines, roots, stats):
+    """ Returns lines reordered so that jumps fall through where possible, without unreachable chains """
+    chains = split_chains(split_blocks(lines))
+    if len(chains) < 2:
+        return lines
+
+    entry = chains[0]
+    fall_off = chains[-1] if chains[-1].blocks[-1].falls_through else None
+    chain_of = {label: chain for chain in chains for block in chain.blocks for label in block.labels}
+    depths = loop_depths(lines)
+
+    candidates = []
+    for chain in chains:
+        tail = chain.blocks[-1]
+        jump = tail.last
+        if not isinstance(jump, JMP_PC):
+            continue
+        target = chain_of.get(jump_target(jump), None)
+        if target is None or target in (chain, entry, fall_off) or jump_target(jump) not in target.head_labels:
+            continue
+        if tail.guarded:
+            continue    # the jump might be skipped over
+        sized = [line for line in chain.lines if line.instruction.size]
+        weight = depths[id(sized[-1])]
+        candidates.append((-weight, chain.index, target.index))
+
+    for weight, source, target in sorted(candidates):
+        source, target = chains[source], chains[target]
+        if source.next is not None or target.previous is not None:
+            continue
+        head = source
+        while head.previous is not None:
+            head = head.previous
+        if head is target:
+            continue
+        source.next, target.previous = target, source
+
+    reachable = set()
+    pending = [entry] + [chain_of[label] for label in roots if label in chain_of]
+    pending.extend(chain for chain in chains if any(block.has_data for block in chain.blocks))
+    while pending:
+        chain = pending.pop()
+        if chain.index in reachable:
+            continue
+        reachable.add(chain.index)
+        pending.extend(chain_of[label] for block in chain.blocks for label in block.targets if label in chain_of)
+
+    # fall_off is never merged, it has to stay at the end of the segment
+    groups = [chain for chain in chains if chain.previous is None]
+    groups.sort(key=lambda chain: chain is fall_off)
+
+    result = []
+    for chain in groups:
+        while chain is not None:
+            if chain.index not in reachable:
+                stats.dropped_blocks += len(chain.blocks)
+                stats.saved_words += sum(line.instruction.size for line in chain.lines)
+            else:
+                chain_lines = chain.lines
+                if chain.next is not None and chain.next.index in reachable:
+                    jump = next(line for line in reversed(chain_lines) if line.instruction.size)
+                    chain_lines.remove(jump)
+                    stats.removed_jumps += 1
+                    stats.saved_words += jump.instruction.size
+                result.extend(chain_lines)
+            chain = chain.next
+    return result
+
+
+def relocate(lines, start):
+    """ Returns copies of lines at consecutive addresses starting at start, with new symbols for the labels
+    that moved. The parsed instructions are left untouched """
+    address = start
+    result = []
+    for line in lines:
+        instruction = line.instruction
+        if not isinstance(instruction, ORG):
+            symbols = instruction.provided_symbols
+            if isinstance(instruction, (LABEL, DataDirective)):
+                symbols = [attr.evolve(symbol, address=address, value=hex(address)) for symbol in symbols]
+            instruction = attr.evolve(instruction, address=address, provided_symbols=symbols)
+            address += instruction.size
+        result.append(attr.evolve(line, instruction=instruction))
+    return result
+
+
+def optimize_layout(lines, symbol_table):
+    """ Returns (lines, LayoutStats) after reordering the basic blocks of every segment.
+    The returned lines hold relocated copies of the instructions, with their own label symbols.
+    Raises NotRelocatable when the program relies on fixed code addresses """
+    labels_of = label_resolver(lines, symbol_table)
+    check_relocatable(lines, labels_of)
+
+    # Labels used as data or jumped to through a definition are kept no matter what
+    roots = set()
+    for line in lines:
+        instruction = line.instruction
+        target = jump_target(instruction)
+        for identifier in instruction.required_symbols:
+            if identifier == target and labels_of(identifier) == {identifier}:
+                continue
+            roots.update(labels_of(identifier))
+
+    # As are jump targets in other segments
+    segments = split_segments(lines)
+    for start, segment in segments:
+        own_labels = set(label for block in split_blocks(segment) for label in block.labels)
+        for line in segment:
+            target = jump_target(line.instruction)
+            if target is not None and target not in own_labels:
+                roots.update(labels_of(target))
+
+    stats = LayoutStats()
+    result = []
+    for start, segment in segments:
+        result.extend(relocate(layout_segment(segment, roots, stats), start))
+    return result, stats
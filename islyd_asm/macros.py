@@ -0,0 +1,162 @@
+""" MACRO / ENDM support.
+
+Macro bodies are matched against the instruction set once, when the macro is
+defined. Each body line keeps the instruction class and the text captured by
+its pattern, so invoking the macro only substitutes parameters and local labels
+in those captures and hands them to the instruction parse() method. Lines that
+do not mention parameters nor local labels are parsed right away and stamped out
+with a new address, like cached lines in the Parser.
+"""
+
+import re
+
+import attr
+
+from .instructions import (match_instruction, UnknownInstruction, LABEL, EQU, DataDirective,
+                           MultipleArgumentsInstruction)
+
+
+MACRO_START = re.compile(r'MACRO\s+(?P<name>[A-Z_]\w*)(?:\s+(?P<parameters>\w+(?:\s*,\s*\w+)*))?', re.I)
+MACRO_END = re.compile(r'ENDM', re.I)
+INVOCATION = re.compile(r'(?P<name>[A-Z_]\w*)(?:\s+(?P<arguments>.*))?', re.I)
+
+# Groups captured by the patterns of MultipleArgumentsInstruction, as (literal, identifier, expression)
+OPERAND_SLOTS = [
+    ('value', 'identifier', 'expression'),
+    ('jump_target', 'jump_target_identifier', 'jump_target_expression'),
+]
+OPERAND_LITERAL = re.compile(r'\$[\dA-F]{1,4}|[0-7]', re.I)
+OPERAND_IDENTIFIER = re.compile(r'\w{3,}')
+
+
+class MacroError(ValueError):
+    pass
+
+
+def split_arguments(text):
+    """ Splits a comma separated argument list """
+    if text is None or not text.strip():
+        return []
+    return [argument.strip() for argument in text.split(',')]
+
+
+@attr.s
+class SlotMatch:
+    """ Stands in for a pattern match when parsing a body line with substituted captures """
+    groups = attr.ib(factory=dict)
+
+    def group(self, name):
+        return self.groups.get(name, None)
+
+    def groupdict(self):
+        return dict(self.groups)
+
+
+@attr.s
+class BodyLine:
+    instruction = attr.ib(default=None)     # instruction class
+    groups = attr.ib(factory=dict)          # text captured by the instruction pattern
+    template = attr.ib(default=None)        # already parsed instruction, when nothing needs substituting
+    macro = attr.ib(default=None)           # name of a macro invoked from this one
+    arguments = attr.ib(factory=list)       # and its arguments
+
+
+@attr.s
+class Macro:
+    name = attr.ib()
+    parameters = attr.ib(factory=list)
+    locals = attr.ib(factory=list)          # labels and definitions made unique on each invocation
+    body = attr.ib(factory=list)            # [BodyLine]
+    names = attr.ib(default=None)           # pattern matching any parameter or local
+
+    @classmethod
+    def define(cls, name, parameters, lines, macros=None):
+        """ Builds a macro from its (normalized) body lines. macros holds the ones that can be invoked from it """
+        macros = macros or {}
+        if len(set(parameters)) != len(parameters):
+            raise MacroError('Repeated parameter names in macro {}'.format(name))
+
+        matched = []
+        for line in lines:
+            if MACRO_START.fullmatch(line):
+                raise MacroError('Macro {} can not define other macros'.format(name))
+
+            invocation = INVOCATION.fullmatch(line)
+            if invocation and invocation.group('name').lower() in macros:
+                matched.append((None, invocation))
+                continue
+
+            instruction, matches = match_instruction(line)
+            if instruction is UnknownInstruction:
+                raise MacroError('Unknown instruction in macro {}:\n{}'.format(name, line))
+            matched.append((instruction, matches))
+
+        macro = cls(name=name, parameters=list(parameters))
+        for instruction, matches in matched:
+            if instruction in (LABEL, EQU) or (instruction is not None and issubclass(instruction, DataDirective)):
+                if matches.group('label') is not None:
+                    macro.locals.append(matches.group('label'))
+
+        substituted = macro.parameters + macro.locals
+        if substituted:
+            macro.names = re.compile(r'\b(?:{})\b'.format('|'.join(map(re.escape, substituted))))
+
+        for instruction, matches in matched:
+            if instruction is None:
+                body_line = BodyLine(macro=matches.group('name').lower(), arguments=split_arguments(matches.group('arguments')))
+            else:
+                groups = matches.groupdict()
+                body_line = BodyLine(instruction=instruction, groups=groups)
+                if not any(macro.mentions(text) for text in groups.values()):
+                    body_line.template = instruction(address=None).parse(matches, matches.string, None)
+            macro.body.append(body_line)
+
+        return macro
+
+    def mentions(self, text):
+        return self.names is not None and text is not None and self.names.search(text) is not None
+
+    def bind(self, arguments, serial):
+        """ Maps parameters to arguments and locals to names unique to this invocation """
+        if len(arguments) != len(self.parameters):
+            raise MacroError('Macro {} takes {} arguments, {} given'.format(self.name, len(self.parameters), len(arguments)))
+
+        bindings = dict(zip(self.parameters, arguments))
+        for local in self.locals:
+            bindings[local] = '{}__{}_{}'.format(local, self.name, serial)
+        return bindings
+
+    def substitute(self, text, bindings):
+        if not self.mentions(text):
+            return text
+        return self.names.sub(lambda matches: bindings[matches.group(0)], text)
+
+    def instantiate(self, body_line, bindings, address):
+        """ Returns a new instruction for body_line at address """
+        if body_line.template is not None:
+            return attr.evolve(body_line.template, address=address)
+
+        groups = {name: self.substitute(text, bindings) for name, text in body_line.groups.items()}
+        if issubclass(body_line.instruction, MultipleArgumentsInstruction):
+            classify_operands(groups)
+
+        instance = body_line.instruction(address=address)
+        return instance.parse(SlotMatch(groups), None, address)
+
+
+def classify_operands(groups):
+    """ Moves each substituted operand to the group its instruction pattern would have captured it in """
+    for slots in OPERAND_SLOTS:
+        texts = [groups.get(slot, None) for slot in slots]
+        text = next((text for text in texts if text is not None), None)
+        if text is None:
+            continue
+
+        for slot in slots:
+            groups[slot] = None
+        if OPERAND_LITERAL.fullmatch(text):
+            groups[slots[0]] = text
+        elif OPERAND_IDENTIFIER.fullmatch(text):
+            groups[slots[1]] = text
+        else:
+            groups[slots[2]] = text
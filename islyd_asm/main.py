@@ -1,8 +1,11 @@
+import os
 import sys
 import argparse
 from pathlib import PurePath
 
 from .assembler import Assembler
+from .backends import BACKENDS, format_for_suffix
+from .cache import BuildCache, CACHE_DIR_ENV, cache_size_from_environment
 
 
 def run():
@@ -12,7 +15,23 @@ def run():
                         required=False,
                         type=str,
                         default='',
-                        help='Compiled IHEX file name (defaults to asmfile with hex suffix if not provided)')
+                        help='Compiled output file name (defaults to asmfile with the suffix of the output format if not provided)')
+
+    parser.add_argument('-f', '--format',
+                        required=False,
+                        choices=list(BACKENDS),
+                        default=None,
+                        help='Output format (defaults to the one matching the output file suffix, or ihex)')
+
+    parser.add_argument('-O', '--optimize',
+                        action='store_true',
+                        help='Reorder basic blocks to remove jumps and unreachable code')
+
+    parser.add_argument('--cache-dir',
+                        required=False,
+                        type=str,
+                        default=os.environ.get(CACHE_DIR_ENV, ''),
+                        help='Reuse outputs of identical builds from this directory (defaults to ${})'.format(CACHE_DIR_ENV))
 
     parser.add_argument('asmfile',
                         type=str,
@@ -20,14 +39,32 @@ def run():
 
     args = parser.parse_args()
 
-    assembler = Assembler()
+    output = args.output
+    output_format = args.format
+    if output_format is None:
+        output_format = format_for_suffix(PurePath(output).suffix)
+
+    if not output:
+        suffix, backend = BACKENDS[output_format]
+        output = str(PurePath(args.asmfile).with_suffix(suffix))
+    name = PurePath(output).stem
+    directory = os.path.dirname(args.asmfile)
 
     with open(args.asmfile) as f:
-        assembler.parse(f).compile()
+        source = f.readlines()
 
-    output = args.output
-    if not output:
-        output = str(PurePath(args.asmfile).with_suffix('.hex'))
+    cache = None
+    if args.cache_dir:
+        cache = BuildCache(args.cache_dir, max_size=cache_size_from_environment())
+        key = cache.key(source, format=output_format, name=name, optimize=args.optimize)
+        if cache.fetch(key, output, directory):
+            return
+
+    with Assembler(directory=directory) as assembler:
+        result = assembler.assemble(source, output_format, name=name, optimize=args.optimize)
 
     with open(output, 'w') as f:
-        f.write(assembler.to_ihex())
+        f.write(result)
+
+    if cache is not None:
+        cache.store(key, output, assembler.included_files(), directory)
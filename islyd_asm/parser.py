@@ -1,40 +1,167 @@
 #!/usr/bin/env python3
 
+import os
 import re
 
 import attr
-from .instructions import ALL_INSTRUCTIONS, is_instruction, UnknownInstruction
+from .instructions import match_instruction, UnknownInstruction, ORG, INCBIN
+from .macros import Macro, MacroError, MACRO_START, MACRO_END, INVOCATION, split_arguments
+from .utils import LRUCache
 
 
 @attr.s
 class Parser:
-    """ Simple instruction parser that keeps track of current memory address """
+    """ Simple instruction parser that keeps track of current memory address.
+    Files included with INCBIN are looked up relative to directory.
+
+    Lines that parse to an instruction neither providing symbols nor depending
+    on its own address are kept in a bounded LRU cache keyed by the normalized
+    line text. Repeated occurrences are stamped from the cached template,
+    sharing its opcode and arguments, and only carry their own address.
+
+    Use expand_line() to get macro definitions and invocations handled too.
+
+    A Parser holds the state of one assembly (current address, cache, macros),
+    use a new one for each source instead of sharing it between threads.
+    """
     base_address = attr.ib(default=0)
     current_address = attr.ib()
+    directory = attr.ib(default='')
+    cache_size = attr.ib(default=1024)
+    cache = attr.ib(init=False, repr=False)
+    # lowercase name -> Macro
+    macros = attr.ib(factory=dict, init=False, repr=False)
+    # (name, parameters, body lines) of the macro being defined
+    recording = attr.ib(default=None, init=False, repr=False)
+    expansions = attr.ib(default=0, init=False, repr=False)
+    # INCBIN instructions loaded so far
+    included = attr.ib(factory=list, init=False, repr=False)
 
     @current_address.default
     def _get_initial_current_address(self):
         return self.base_address
 
-    def parse_line(self, line):
+    @cache.default
+    def _get_cache(self):
+        return LRUCache(maxsize=self.cache_size)
+
+    def cache_info(self):
+        """ Returns (hits, misses, maxsize, currsize) for the line cache """
+        return self.cache.info()
+
+    @staticmethod
+    def normalize(line):
+        """ Strips comments and surrounding whitespace, returns an empty string for blank or comment lines """
         line = line.strip()
 
         if not line:
-            return None
+            return ''
 
         if line.startswith(';'):   # Comments
-            return None
+            return ''
 
         # remove comments and extra whitespace
         line = re.split(r';[\w\s]*$', line)[0]
-        line = line.strip()
+        return line.strip()
+
+    def parse_line(self, line):
+        line = self.normalize(line)
+
+        if not line:
+            return None
+
+        return self._parse(line)
+
+    def expand_line(self, line):
+        """ Returns the list of instructions line stands for, handling macro definitions and invocations """
+        line = self.normalize(line)
+
+        if not line:
+            return []
+
+        if self.recording is not None:
+            if MACRO_END.fullmatch(line):
+                self._define_macro(*self.recording)
+                self.recording = None
+            else:
+                self.recording[2].append(line)
+            return []
+
+        start = MACRO_START.fullmatch(line)
+        if start:
+            self.recording = (start.group('name'), split_arguments(start.group('parameters')), [])
+            return []
+
+        if MACRO_END.fullmatch(line):
+            raise MacroError('ENDM without MACRO')
+
+        if self.macros:
+            invocation = INVOCATION.fullmatch(line)
+            macro = invocation and self.macros.get(invocation.group('name').lower(), None)
+            if macro:
+                return list(self._expand_macro(macro, split_arguments(invocation.group('arguments'))))
+
+        return [self._parse(line)]
+
+    def _define_macro(self, name, parameters, lines):
+        if name.lower() in self.macros:
+            raise MacroError('Macro {} is already defined'.format(name))
+        self.macros[name.lower()] = Macro.define(name, parameters, lines, self.macros)
+
+    def _expand_macro(self, macro, arguments):
+        self.expansions += 1
+        bindings = macro.bind(arguments, self.expansions)
+        for body_line in macro.body:
+            if body_line.macro is not None:
+                nested = [macro.substitute(argument, bindings) for argument in body_line.arguments]
+                yield from self._expand_macro(self.macros[body_line.macro], nested)
+            else:
+                yield self._advance(macro.instantiate(body_line, bindings, self.current_address))
+
+    def _parse(self, line):
+        template = self.cache.get(line)
+        if template is None:
+            parsed_instruction = self._parse_normalized(line)
+            if self._is_cacheable(parsed_instruction):
+                self.cache.put(line, attr.evolve(parsed_instruction, address=None))
+        else:
+            parsed_instruction = attr.evolve(template, address=self.current_address)
+
+        return self._advance(parsed_instruction)
+
+    def _advance(self, parsed_instruction):
+        """ Moves the current address past parsed_instruction """
+        if isinstance(parsed_instruction, INCBIN):
+            parsed_instruction.load(self.directory)
+            self.included.append(parsed_instruction)
+
+        if isinstance(parsed_instruction, ORG):
+            self.current_address = parsed_instruction.origin
+        else:
+            self.current_address += parsed_instruction.size
+        return parsed_instruction
+
+    def close(self):
+        """ Releases the files mapped by INCBIN directives """
+        for instruction in self.included:
+            instruction.close()
+
+    def included_files(self):
+        """ Returns the paths of the files pulled in by the INCBIN directives parsed so far, without repetitions """
+        return list(dict.fromkeys(os.path.join(self.directory, instruction.filename) for instruction in self.included))
+
+    def _parse_normalized(self, line):
+        instruction, matches = match_instruction(line)
+        if matches is None:
+            return UnknownInstruction.from_data(line, address=self.current_address)
+        return instruction(address=self.current_address).parse(matches, line, self.current_address)
 
-        for instruction in ALL_INSTRUCTIONS:
-            if is_instruction(line, instruction):
-                parsed_instruction = instruction.from_data(line, self.current_address)
-                self.current_address += parsed_instruction.size
-                return parsed_instruction
-        return UnknownInstruction.from_data(line, address=self.current_address)
+    @staticmethod
+    def _is_cacheable(instruction):
+        # Labels and definitions bind their own address and are unique anyway
+        if isinstance(instruction, UnknownInstruction):
+            return False
+        return not instruction.provided_symbols
 
 
 if __name__ == '__main__':
@@ -42,4 +169,6 @@ if __name__ == '__main__':
 
     parser = Parser()
     for line in fileinput.input():
-        print(parser.parse_line(line))
+        for instruction in parser.expand_line(line):
+            print(instruction)
+    print(parser.cache_info())
@@ -0,0 +1,97 @@
+import struct
+from bisect import bisect_left
+
+import attr
+
+
+MAX_ADDRESS = 0xFFFF
+
+
+class SegmentOverlapError(Exception):
+    def __init__(self, msg, segment=None):
+        super().__init__(msg)
+        self.segment = segment
+
+
+class AddressOverflowError(Exception):
+    pass
+
+
+@attr.s
+class Segment:
+    """ Contiguous run of emitted lines starting at a fixed address """
+    start = attr.ib(default=0)
+    end = attr.ib()             # first address past this segment
+    lines = attr.ib(factory=list, repr=False)   # [LineInfo]
+
+    @end.default
+    def _get_initial_end(self):
+        return self.start
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def data(self):
+        """ Returns the bytes held by this segment, only meaningful after compiling """
+        return b''.join(bytes(line.opcode) for line in self.lines)
+
+    def words(self):
+        """ Returns the 16 bit words held by this segment, only meaningful after compiling """
+        data = self.data()
+        return list(struct.unpack('>{}H'.format(len(data) // 2), data))
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+@attr.s
+class SegmentMap:
+    """ Sparse memory map kept as a list of non overlapping segments sorted by address.
+    Only addresses actually holding code take space, no matter how far apart segments are """
+    segments = attr.ib(factory=list, init=False)
+    current = attr.ib(default=None, init=False)
+    _starts = attr.ib(factory=list, init=False, repr=False)
+
+    def place(self, line_info):
+        """ Adds a sized line to the open segment, starting a new one whenever its address is not contiguous """
+        instruction = line_info.instruction
+        address = instruction.address
+        end = address + instruction.size
+
+        if end - 1 > MAX_ADDRESS:
+            raise AddressOverflowError('Address ${:04x} is past the end of memory'.format(end - 1))
+
+        if self.current is None or self.current.end != address:
+            self.close()
+            self.current = Segment(start=address)
+
+        self.current.lines.append(line_info)
+        self.current.end = end
+
+    def close(self):
+        """ Closes the open segment and inserts it into the map """
+        segment, self.current = self.current, None
+        if segment is None or not segment.size:
+            return
+
+        index = bisect_left(self._starts, segment.start)
+        for neighbour in self.segments[max(index - 1, 0):index + 1]:
+            if segment.overlaps(neighbour):
+                msg = 'Segment ${:04x}-${:04x} overlaps segment ${:04x}-${:04x}'.format(
+                    segment.start, segment.end - 1, neighbour.start, neighbour.end - 1)
+                raise SegmentOverlapError(msg, segment)
+
+        self.segments.insert(index, segment)
+        self._starts.insert(index, segment.start)
+
+    @property
+    def end(self):
+        """ First address past the last segment """
+        return self.segments[-1].end if self.segments else 0
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
@@ -1,6 +1,9 @@
 import attr
+from types import MappingProxyType
 from collections import OrderedDict
 
+from .expressions import LITERAL, ExpressionError, compile_expression
+
 
 class SymbolRedefinedError(Exception):
     pass
@@ -10,12 +13,21 @@ class UndefinedSymbol(Exception):
     pass
 
 
+class CircularDefinition(Exception):
+    pass
+
+
 @attr.s
 class SymbolTable:
     # identifier -> Symbol
     symbols = attr.ib(factory=OrderedDict)
     # set of symbol identifiers
     dependencies = attr.ib(factory=set)
+    # identifier -> integer value, filled on demand
+    values = attr.ib(factory=dict, init=False, repr=False)
+    # expression node -> integer value, shared by every expression folded against this table
+    folded = attr.ib(factory=dict, init=False, repr=False)
+    resolving = attr.ib(factory=set, init=False, repr=False)
 
     def add(self, symbol):
         identifier = symbol.identifier
@@ -24,11 +36,17 @@ class SymbolTable:
             raise SymbolRedefinedError(identifier)
         else:
             self.symbols[identifier] = symbol
+            self.invalidate()
             try:
                 self.dependencies.remove(identifier)
             except KeyError:
                 pass
 
+    def invalidate(self):
+        """ Forgets every computed value, for when symbols are added or moved """
+        self.values.clear()
+        self.folded.clear()
+
     def add_dependency(self, identifier):
         identifier = identifier.strip()
         if identifier not in self.symbols:
@@ -40,3 +58,79 @@ class SymbolTable:
             return self.symbols[identifier]
         except KeyError:
             raise UndefinedSymbol(identifier)
+
+    def value_of(self, identifier):
+        """ Returns the integer value of a symbol, evaluating its definition if it is an expression """
+        identifier = identifier.strip()
+        try:
+            return self.values[identifier]
+        except KeyError:
+            pass
+
+        if identifier in self.resolving:
+            raise CircularDefinition('Symbol "{}" is defined in terms of itself'.format(identifier))
+
+        symbol = self.get(identifier)
+        self.resolving.add(identifier)
+        try:
+            value = str(symbol.value).strip()
+            if LITERAL.fullmatch(value):
+                value = int(value.replace('$', ''), 16)
+            else:
+                value = self.evaluate(compile_expression(value))
+        finally:
+            self.resolving.discard(identifier)
+
+        self.values[identifier] = value
+        return value
+
+    def evaluate(self, expression):
+        """ Folds a compiled expression using the values of the symbols in this table """
+        return expression.evaluate(self.value_of, self.folded)
+
+    def freeze(self):
+        """ Returns a FrozenSymbolTable with the value of every symbol already worked out """
+        values = {}
+        for identifier in self.symbols:
+            try:
+                values[identifier] = self.value_of(identifier)
+            except (CircularDefinition, UndefinedSymbol, ExpressionError, ValueError) as e:
+                # only an error if some instruction uses it
+                values[identifier] = (type(e), str(e))
+        return FrozenSymbolTable(symbols=MappingProxyType(OrderedDict(self.symbols)), values=MappingProxyType(values),
+                                 folded=dict(self.folded))
+
+
+@attr.s(frozen=True)
+class FrozenSymbolTable:
+    """ Symbol table whose symbols and values can not change, made by SymbolTable.freeze() for each compile().
+    Has the same lookup methods as SymbolTable. evaluate() adds entries to the folded memo, which belongs
+    to the assembler that froze the table """
+    # identifier -> Symbol
+    symbols = attr.ib(factory=lambda: MappingProxyType({}))
+    # identifier -> integer value, or (exception class, message) if it could not be worked out
+    values = attr.ib(factory=lambda: MappingProxyType({}))
+    # expression node -> folded value, starts with the nodes folded while working out values
+    folded = attr.ib(factory=dict, eq=False, repr=False)
+
+    def get(self, identifier):
+        identifier = identifier.strip()
+        try:
+            return self.symbols[identifier]
+        except KeyError:
+            raise UndefinedSymbol(identifier)
+
+    def value_of(self, identifier):
+        identifier = identifier.strip()
+        try:
+            value = self.values[identifier]
+        except KeyError:
+            raise UndefinedSymbol(identifier)
+
+        if isinstance(value, tuple):
+            exception, message = value
+            raise exception(message)
+        return value
+
+    def evaluate(self, expression):
+        return expression.evaluate(self.value_of, self.folded)
@@ -12,7 +12,8 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='islyd-asm',
     version=__version__,
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
+    test_suite='tests',
     include_package_data=True,
     install_requires=[
         'attrs',
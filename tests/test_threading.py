@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from islyd_asm.assembler import assemble
+from islyd_asm.backends import BACKENDS
+from islyd_asm.symbol_table import UndefinedSymbol
+
+
+PROGRAMS = 24
+ROUNDS = 10
+WORKERS = 16
+
+# Has to fail the same way when assembled in parallel
+UNDEFINED = ['    LDI RX, missing+1']
+
+
+def program(seed):
+    """ Returns source lines exercising definitions, expressions, macros and data, varying with seed """
+    return [
+        'MACRO pulse bit, delay',
+        '    BIT SET bit, PORTA',
+        '    LDI RX, delay',
+        'wait:',
+        '    DEC RX',
+        '    JMP PC IF Z, done',
+        '    JMP PC, wait',
+        'done:',
+        '    BIT CLR bit, PORTA',
+        'ENDM',
+        'BASE EQU ${:04X}'.format(0x10 * seed),
+        'COUNT EQU {:X}'.format(seed % 7 + 1),
+        'LIMIT EQU (BASE<<1)+COUNT*3',
+        'start:',
+        '    LDI RX, LIMIT',
+        '    ADD table+{:X}'.format(seed % 3),
+        '    pulse {}, COUNT+1'.format(seed % 8),
+        '    pulse {}, $0010'.format((seed + 3) % 8),
+        '    JMP PC, start',
+        '    ORG ${:04X}'.format(0x100 + 0x10 * seed),
+        'table: DW BASE, LIMIT, -${:X}'.format(seed + 1),
+        'text:  DB $48, $4F, ${:02X}'.format(seed),
+        'blob:  INCBIN "blob.bin", {:X}'.format(seed % 8),
+    ]
+
+
+class ParallelAssemblyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'blob.bin'), 'wb') as f:
+            f.write(bytes(range(0x40)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assemble(self, job):
+        """ Returns the output for job, any error other than the expected one propagates """
+        source, format, optimize = job
+        if source is UNDEFINED:
+            with self.assertRaisesRegex(UndefinedSymbol, 'missing'):
+                assemble(source, format, directory=self.directory)
+            return None
+        return assemble(source, format, name='rom', directory=self.directory, optimize=optimize)
+
+    def test_parallel_output_matches_serial(self):
+        jobs = [(program(seed), format, bool(seed % 2)) for seed in range(PROGRAMS) for format in BACKENDS]
+        jobs.append((UNDEFINED, 'ihex', False))
+
+        serial = [self.assemble(job) for job in jobs]
+        outputs = serial[:-1]
+        self.assertTrue(all(outputs))
+        self.assertEqual(len(set(outputs)), len(outputs))
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            for _ in range(ROUNDS):
+                self.assertEqual(list(executor.map(self.assemble, jobs)), serial)
+
+
+if __name__ == '__main__':
+    unittest.main()